@@ -2,7 +2,9 @@
 # |D|A| |S|P|U|D| |L|O|R|D|
 # +-+-+ +-+-+-+-+ +-+-+-+-+
 
+import collections
 from enum import Enum
+import errno
 import mmap
 import os
 import struct
@@ -57,6 +59,11 @@ class FileType(Enum):
     GIA = 3
     GIR = 4
 
+# Enum members/values used on every run, bound once so the hot paths don't go through the Enum classes
+MODE_BEYOND     = AssetMode.BEYOND
+MODE_CLASSIC    = AssetMode.CLASSIC
+FILE_TYPE_GIA   = FileType.GIA.value
+
 class Header(NamedTuple):
     Struct  = struct.Struct(">IIIII")   # big endian uint32_t x5
     
@@ -76,70 +83,335 @@ class Footer(NamedTuple):
     
     magic_num   : int
 
+# Struct sizes and methods bound once here, so they aren't looked up through the classes on every use
+HEADER_SIZE = Header.Struct.size
+FOOTER_SIZE = Footer.Struct.size
+header_unpack       = Header.Struct.unpack
+header_unpack_from  = Header.Struct.unpack_from
+header_pack         = Header.Struct.pack
+footer_unpack_from  = Footer.Struct.unpack_from
+
 CLASSIC_MODE_TAG    = bytes.fromhex("20 01");
 FILENAME_TERMINATOR = bytes.fromhex("2A 05");
 
+# For checking the classic mode tag and the filename terminator after it in place with one integer compare,
+# without slicing them out of the file
+CLASSIC_TAG_TERM_STRUCT = struct.Struct(">I")   # big endian uint32_t x1
+CLASSIC_TAG_TERM_VALUE  = int.from_bytes(CLASSIC_MODE_TAG + FILENAME_TERMINATOR, "big")
+
+# The filename terminator is normally just ahead of the footer (only the filename sits between them),
+# so only this many bytes before the footer are searched at first, before falling back to the whole file
+TAG_SEARCH_WINDOW   = 4096
+
+# Extra flags for os.open
+O_BINARY    = getattr(os, "O_BINARY", 0)    # only available/needed on windows, 0 elsewhere
+O_NOATIME   = getattr(os, "O_NOATIME", 0)   # linux only - skips writing the access time back for read-only opens
+
+# Optional syscalls, checked once here rather than on every call
+HAVE_WRITEV = hasattr(os, "writev")         # not on windows
+HAVE_PREAD  = hasattr(os, "pread")          # not on windows
+HAVE_PWRITE = hasattr(os, "pwrite")         # not on windows
+HAVE_FADVISE    = hasattr(os, "posix_fadvise")  # not on windows or macos
+HAVE_MADVISE    = hasattr(mmap.mmap, "madvise") # not on windows
+
+
+
+# Ways of having the kernel copy a range of one file to another without going through userspace,
+# most preferred first. Each takes (src_fd, dst_fd, offset, count) and returns the number of bytes copied.
+Kernel_Copies   = []
+if hasattr(os, "copy_file_range"):
+    # linux only
+    Kernel_Copies.append(lambda src_fd, dst_fd, offset, count:
+        os.copy_file_range(src_fd, dst_fd, count, offset_src = offset))
+if hasattr(os, "sendfile"):
+    # on linux this works between any files, elsewhere dst may need to be a socket (then it just fails)
+    Kernel_Copies.append(lambda src_fd, dst_fd, offset, count:
+        os.sendfile(dst_fd, src_fd, offset, count))
+
+# Errors from the kernel copies that just mean the method doesn't work for these files
+# (anything else, like a full disk, is a real error that the next method would only run into again)
+KERNEL_COPY_UNSUPPORTED = {errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP, errno.ENOTSOCK}
+
+# Opens the src file with os.open
+# O_NOATIME is only allowed for the file's owner (or root), so if it's refused, open without it
+def open_src(src_path, open_flags):
+    open_flags  |= O_BINARY
+    
+    if open_flags & O_NOATIME:
+        try:
+            return os.open(src_path, open_flags)
+        except PermissionError:
+            open_flags  &= ~O_NOATIME
+    
+    return os.open(src_path, open_flags)
+
+# Advises the kernel how the file behind fd is going to be used, e.g. advise_fd(fd, "POSIX_FADV_SEQUENTIAL")
+# Only a hint, so it's skipped where posix_fadvise isn't available (windows, macos) or fails
+def advise_fd(fd, advice):
+    if HAVE_FADVISE:
+        try:
+            os.posix_fadvise(fd, 0, 0, getattr(os, advice))
+        except OSError:
+            pass
+
+# Same for a range of an mmap, e.g. advise_map(src, "MADV_RANDOM") (without a length, up to the end)
+# Skipped where madvise isn't available (windows) or fails
+def advise_map(src, advice, start = 0, length = None):
+    if HAVE_MADVISE:
+        if length == None:
+            length  = len(src) - start
+        
+        # start has to be page aligned
+        misalign    = start % mmap.PAGESIZE
+        
+        try:
+            src.madvise(getattr(mmap, advice), start - misalign, length + misalign)
+        except OSError:
+            pass
+
+# Writes all the given buffers to fd in order, gathered into one syscall where possible
+def write_all(fd, *buffers):
+    buffers = list(buffers)
+    try:
+        while len(buffers) > 0:
+            if HAVE_WRITEV:
+                written = os.writev(fd, buffers)
+            else:
+                # not available on windows
+                written = os.write(fd, buffers[0])
+            
+            # Drop whatever got written (writes can come up short)
+            while len(buffers) > 0 and written >= len(buffers[0]):
+                written -= len(buffers[0])
+                buffers.pop(0)
+            if written > 0:
+                buffers[0]  = memoryview(buffers[0])[written : ]
+    finally:
+        # If a write fails, this frame lives on in the traceback - don't let it keep any views
+        # (of an mmap, say) alive with it, otherwise the mmap can't be closed while the error propagates
+        buffers.clear()
+
+# Positioned reads/writes - pread/pwrite aren't available on windows, so seek there instead
+def read_at(fd, size, offset):
+    data    = b""
+    while len(data) < size:
+        if HAVE_PREAD:
+            chunk   = os.pread(fd, size - len(data), offset + len(data))
+        else:
+            os.lseek(fd, offset + len(data), os.SEEK_SET)
+            chunk   = os.read(fd, size - len(data))
+        
+        if len(chunk) == 0:
+            break   # EOF
+        data    += chunk
+    
+    return data
+
+def write_at(fd, data, offset):
+    if HAVE_PWRITE:
+        while len(data) > 0:
+            written = os.pwrite(fd, data, offset)
+            data    = data[written : ]
+            offset  += written
+    else:
+        os.lseek(fd, offset, os.SEEK_SET)
+        write_all(fd, data)
+
+# Copies bytes [start, end) of src_fd to the current position of dst_fd without going through userspace
+# Returns how far it got (end, unless none of the kernel's methods work for these files)
+def kernel_copy_range(src_fd, dst_fd, start, end):
+    for copy in Kernel_Copies:
+        try:
+            while start < end:
+                copied  = copy(src_fd, dst_fd, start, end - start)
+                if copied == 0:
+                    break
+                start   += copied
+        except OSError as e:
+            if e.errno not in KERNEL_COPY_UNSUPPORTED:
+                raise
+            # not supported for these files (e.g. different filesystems), try the next method
+        
+        if start >= end:
+            break
+    
+    return start
+
+# Writes pieces to the current position of dst_fd, in order. Each piece is either a bytes-like object,
+# or a slice of the src file, which the kernel copies directly between the files where possible.
+# src is the mmap of src_fd. If the kernel can't copy, slices are taken from a memoryview of it (no copy)
+# and gather-written together with the other pieces.
+# The view and every slice of it are released before returning, whether or not the writes succeed,
+# since an mmap with views still exported can't be closed.
+def write_pieces(dst_fd, src, src_fd, pieces):
+    kernel_copy = len(Kernel_Copies) > 0
+    pending = []
+    
+    with memoryview(src) as src_view:
+        try:
+            for piece in pieces:
+                if isinstance(piece, slice):
+                    start, end  = piece.start, piece.stop
+                    
+                    if kernel_copy:
+                        # dst position has to be up to date before the kernel copies to it
+                        write_all(dst_fd, *pending)
+                        pending.clear()
+                        
+                        start   = kernel_copy_range(src_fd, dst_fd, start, end)
+                        kernel_copy = start >= end  # if it didn't work this time, it won't next time either
+                    
+                    if start < end:
+                        # It's going to be read through the mapping after all, so have it read ahead
+                        advise_map(src, "MADV_WILLNEED", start, end - start)
+                        pending.append(src_view[start : end])
+                else:
+                    pending.append(piece)
+            
+            write_all(dst_fd, *pending)
+        finally:
+            # Same as write_all - don't keep slices of the view alive in the traceback if a write fails
+            # (releasing the view itself doesn't release them)
+            pending.clear()
+
+
+
+# Validates the header and footer of a src_len byte long GIA file, exits if either is invalid
+def validate_asset(src_path, header, footer, src_len):
+    # Validate header
+    if header.file_len != (src_len - Header.FILE_LEN_EXCLUDED):
+        error_file_invalid(src_path)
+    if header.magic_num != Header.MAGIC_NUM:
+        error_file_invalid(src_path)
+    if header.file_type != FILE_TYPE_GIA:
+        error_file_invalid(src_path)
+    if header.content_len != (src_len - HEADER_SIZE - FOOTER_SIZE):
+        error_file_invalid(src_path)
+    
+    # Validate footer
+    if footer.magic_num != Footer.MAGIC_NUM:
+        error_file_invalid(src_path)
+
+# Finds the filename terminator in buf[start : end], searching backwards from end,
+# and checks for a classic mode tag right before it (only if the tag would begin at or after body_start).
+# Returns (from_mode, ctag_index, fterm_index) as indices into buf, or None if there is no terminator.
+# For a Beyond Mode asset, ctag_index is where the tag would go (i.e. the same as fterm_index).
+def find_tags(buf, start, end, body_start):
+    fterm_index  = buf.rfind(FILENAME_TERMINATOR, start, end)
+    if fterm_index < 0:
+        return None
+    
+    # Expected index of classic mode tag
+    ctag_index   = fterm_index - len(CLASSIC_MODE_TAG)
+    
+    # Check for classic mode tag
+    if ctag_index >= body_start and CLASSIC_TAG_TERM_STRUCT.unpack_from(buf, ctag_index)[0] == CLASSIC_TAG_TERM_VALUE:
+        return MODE_CLASSIC, ctag_index, fterm_index
+    else:
+        return MODE_BEYOND, fterm_index, fterm_index
+
+
 
+def do_giacc_query(src_path):
+    # Only the header and the end of the file are needed, so read just those
+    # instead of mapping the whole file
+    
+    try:
+        src_fd  = open_src(src_path, os.O_RDONLY | O_NOATIME)
+        advise_fd(src_fd, "POSIX_FADV_RANDOM")  # don't read ahead past the bits we need
+        try:
+            src_len = os.fstat(src_fd).st_size
+            if src_len < HEADER_SIZE + FOOTER_SIZE:
+                error_file_invalid(src_path)
+            
+            header  = Header._make(header_unpack(read_at(src_fd, HEADER_SIZE, 0)))
+            
+            # Read the footer, the search window ahead of it, and room for a classic mode tag ahead of that
+            tail_start  = max(0, src_len - FOOTER_SIZE - TAG_SEARCH_WINDOW - len(CLASSIC_MODE_TAG))
+            tail    = read_at(src_fd, src_len - tail_start, tail_start)
+            
+            footer  = Footer._make(footer_unpack_from(tail, len(tail) - FOOTER_SIZE))
+            
+            validate_asset(src_path, header, footer, src_len)
+            
+            # Find filename terminator within the tail (indices here are relative to tail_start)
+            tags    = find_tags(tail, max(HEADER_SIZE - tail_start, len(CLASSIC_MODE_TAG)),
+                len(tail) - FOOTER_SIZE, HEADER_SIZE - tail_start)
+            if tags == None and tail_start > 0:
+                # Unusually long filename (or no terminator at all), search everything after the header
+                # through a mapping, rather than reading the whole file in
+                with mmap.mmap(src_fd, 0, access = mmap.ACCESS_READ) as src:
+                    tags    = find_tags(src, HEADER_SIZE, src_len - FOOTER_SIZE, HEADER_SIZE)
+            if tags == None:
+                error_file_invalid(src_path)
+            
+        finally:
+            os.close(src_fd)
+        
+    except OSError as e:
+        error(e)
+    
+    from_mode   = tags[0]
+    print("This asset is for ", from_mode.name.title(), " Mode.", sep = "")
 
 def do_giacc_convert(src_path, to_mode, dst_path):
     
+    if to_mode == None:
+        # Only querying asset type, don't do any conversion
+        return do_giacc_query(src_path)
+    
     #----- PARSE INPUT FILE -----#
     
     try:
-        if to_mode != None and dst_path == None:
+        if dst_path == None:
             # Destination is same as src, so open in read-write mode
+            # (writes go through the fd though, the mmap is only read from)
             open_flags  = os.O_RDWR
-            mmap_access = mmap.ACCESS_WRITE
         else:
             # We only need read access to src
-            # (either because we aren't doing conversion, or conversion dst is different from src)
-            open_flags  = os.O_RDONLY
-            mmap_access = mmap.ACCESS_READ   # we gotta manually specify this otherwise mmap gets pissy
+            # (conversion dst is different from src)
+            open_flags  = os.O_RDONLY | O_NOATIME
         
-        if os.name == "nt":
-            # only available/needed on windows
-            open_flags |= os.O_BINARY
+        src_fd  = open_src(src_path, open_flags)    # mmap takes a file descriptor
+        if dst_path != None:
+            # Whole file is about to be streamed out to dst (partly via the fd, which madvise doesn't cover)
+            advise_fd(src_fd, "POSIX_FADV_SEQUENTIAL")
         
-        src_fd  = os.open(src_path, open_flags) # mmap takes a file descriptor
-        with mmap.mmap(src_fd, 0, access = mmap_access) as src:
+        with mmap.mmap(src_fd, 0, access = mmap.ACCESS_READ) as src:   # we gotta manually specify this otherwise mmap gets pissy
             
-            header  = Header._make(Header.Struct.unpack_from(src, 0))
-            # Validate header
-            if header.file_len != (len(src) - Header.FILE_LEN_EXCLUDED):
-                error_file_invalid(src_path)
-            if header.magic_num != Header.MAGIC_NUM:
-                error_file_invalid(src_path)
-            if header.file_type != FileType.GIA.value:
-                error_file_invalid(src_path)
-            if header.content_len != (len(src) - Header.Struct.size - Footer.Struct.size):
-                error_file_invalid(src_path)
-        
-            footer  = Footer._make(Footer.Struct.unpack(src[-Footer.Struct.size : ]))
-            # Validate footer
-            if footer.magic_num != Footer.MAGIC_NUM:
+            src_len = len(src)
+            
+            if dst_path != None:
+                # Whole file is about to be streamed out to dst
+                # (only prefetched if write_pieces ends up reading it through the mapping,
+                # the kernel copies don't need it and may not have to read the data at all)
+                advise_map(src, "MADV_SEQUENTIAL")
+            else:
+                # Only the header and the end of the file get touched, don't read ahead the rest
+                advise_map(src, "MADV_RANDOM")
+            
+            if src_len < HEADER_SIZE + FOOTER_SIZE:
                 error_file_invalid(src_path)
             
+            header  = Header._make(header_unpack_from(src, 0))
+            footer  = Footer._make(footer_unpack_from(src, src_len - FOOTER_SIZE))
+            
+            validate_asset(src_path, header, footer, src_len)
+            
             # Find index of filename terminator, searching backwards from footer
-            fterm_index  = src.rfind(FILENAME_TERMINATOR, 0, -Footer.Struct.size)
-            if fterm_index < 0:
+            fterm_end   = src_len - FOOTER_SIZE
+            window_start    = fterm_end - TAG_SEARCH_WINDOW
+            tags    = find_tags(src, max(HEADER_SIZE, window_start), fterm_end, HEADER_SIZE)
+            if tags == None and window_start > HEADER_SIZE:
+                # Unusually long filename, search everything after the header
+                tags    = find_tags(src, HEADER_SIZE, fterm_end, HEADER_SIZE)
+            if tags == None:
                 error_file_invalid(src_path)
             
-            # Expected index of classic mode tag
-            ctag_index   = fterm_index - len(CLASSIC_MODE_TAG)
-            
-            # Check for classic mode tag
-            if ctag_index >= Header.Struct.size and src[ctag_index : fterm_index] == CLASSIC_MODE_TAG:
-                from_mode   = AssetMode.CLASSIC
-            else:
-                from_mode   = AssetMode.BEYOND
-                ctag_index  = fterm_index
+            from_mode, ctag_index, fterm_index = tags
             
             print("This asset is", " already" if from_mode == to_mode else "", " for ", from_mode.name.title(), " Mode.", sep = "")
             
-            if to_mode == None:
-                # Only querying asset type, don't do any conversion
-                return
-            
             #----- WRITE OUTPUT FILE -----#
             
             if from_mode == to_mode:
@@ -151,15 +423,15 @@ def do_giacc_convert(src_path, to_mode, dst_path):
                 
                 else:
                     # Copy source to destination unmodified
-                    with open(dst_path, "wb") as dst:
-                        dst.write(src)
+                    with open(dst_path, "wb", buffering = 0) as dst:
+                        write_pieces(dst.fileno(), src, src_fd, [slice(0, src_len)])
             else:
                 print("Converting asset to", to_mode.name.title(), "Mode...")
                 
                 # Correct header length fields
-                if to_mode == AssetMode.CLASSIC:
+                if to_mode == MODE_CLASSIC:
                     len_adjustment  = +len(CLASSIC_MODE_TAG)
-                elif to_mode == AssetMode.BEYOND:
+                elif to_mode == MODE_BEYOND:
                     len_adjustment  = -len(CLASSIC_MODE_TAG)
                 else:
                     raise ValueError()
@@ -173,37 +445,49 @@ def do_giacc_convert(src_path, to_mode, dst_path):
                 
                 if dst_path == None:
                     # Write converted file back to input file
-                    # (in this case, we just modify the mmap'd src in-place)
+                    # (done through the fd rather than the mmap, since mmap.resize is buggy on windows)
+                    # Only the filename and footer come after the tag, so the part that has to shift is small
+                    # (len_old - fterm_index bytes, not the whole payload)
+                    
+                    len_old = src_len
+                    tail    = read_at(src_fd, len_old - fterm_index, fterm_index)
                     
-                    len_old = len(src)
-                    if to_mode == AssetMode.CLASSIC:
+                    src.close() # Unmap first, the file can't be resized while it's mapped
+                    
+                    if to_mode == MODE_CLASSIC:
                         # Make room for the classic mode tag
-                        src.resize(len_old + len_adjustment)    # First grow the file
-                        src.move(fterm_index_new, fterm_index, len_old - fterm_index)   # Shift everything after the tag down
-                        
-                        src[ctag_index : ctag_index + len(CLASSIC_MODE_TAG)] = CLASSIC_MODE_TAG  # and write the tag
+                        os.ftruncate(src_fd, len_old + len_adjustment)  # First grow the file
+                        write_at(src_fd, CLASSIC_MODE_TAG + tail, ctag_index)   # Then write the tag, with everything after it shifted down
                     else:
                         # Delete the classic mode tag
-                        src.move(fterm_index_new, fterm_index, len_old - fterm_index)   # Shift everything after the tag up
-                        src.resize(len_old + len_adjustment)    # And shrink the file
+                        write_at(src_fd, tail, fterm_index_new) # Shift everything after the tag up
+                        os.ftruncate(src_fd, len_old + len_adjustment)  # And shrink the file
                     
-                    Header.Struct.pack_into(src, 0, *header_new) # Also rewrite the header
+                    write_at(src_fd, header_pack(*header_new), 0)  # Also rewrite the header
                     
                 else:
                     # Copy to destination with classic mode tag added/removed
-                    with open(dst_path, "wb") as dst:
-                        
-                        dst.write(Header.Struct.pack(*header_new))
-                        
-                        # Write everything before the classic mode tags
-                        dst.write(src[Header.Struct.size : ctag_index])
-                        
-                        if to_mode == AssetMode.CLASSIC:
-                            # Write the classic mode tag
-                            dst.write(CLASSIC_MODE_TAG)
-                        
-                        # Everything else
-                        dst.write(src[fterm_index : ])
+                    pieces  = [
+                        header_pack(*header_new),
+                        slice(HEADER_SIZE, ctag_index), # Everything before the classic mode tag
+                    ]
+                    
+                    if to_mode == MODE_CLASSIC:
+                        # The classic mode tag
+                        pieces.append(CLASSIC_MODE_TAG)
+                    
+                    # Everything else
+                    pieces.append(slice(fterm_index, src_len))
+                    
+                    # (the bulk of the file is copied fd-to-fd, so write through the raw fd throughout
+                    # and don't bother with a write buffer)
+                    with open(dst_path, "wb", buffering = 0) as dst:
+                        write_pieces(dst.fileno(), src, src_fd, pieces)
+        
+        if dst_path != None:
+            # Source has been copied out, let its pages go so it doesn't crowd out the page cache
+            # (only once it's unmapped, mapped pages aren't dropped)
+            advise_fd(src_fd, "POSIX_FADV_DONTNEED")
         
     except OSError as e:
         error(e)
@@ -252,7 +536,15 @@ class OperationForm:
         self.__oper = op
         self.__name = name
         self.__params   = params
-        self.__func = func
+        
+        # Usage line for this form, parameters don't change so only build it once
+        self.__printable    = " ".join(["> giacc.py", name, *(f"[{p}]" for p in params)])
+        
+        # Decide now what invoking the form does, rather than every time it's called
+        if func != None:
+            self.__invoke   = lambda op_name, *args: func(*args)
+        else:
+            self.__invoke   = lambda op_name, *args: op(self, op_name, *args)
     
     def operation(self):    # Operation that this form belongs to
         return self.__oper
@@ -265,14 +557,10 @@ class OperationForm:
     # Override in derived class to execute operation when invoked in command line.
     # If not overridden, executes function passed to constructor (if any), or forwards to owning operation
     def __call__(self, op_name, *args):
-        if self.__func != None:
-            self.__func(*args)
-        else:
-            self.operation()(self, op_name, *args)
+        self.__invoke(op_name, *args)
     
     def print_form(self, dst = sys.stdout):
-        params  = (f"[{p}]" for p in self.parameters())
-        print("> giacc.py", self.name(), *params, file = dst)
+        print(self.__printable, file = dst)
 
 
 
@@ -313,7 +601,7 @@ class QueryOperation(BaseOperation):
                 " No conversion is performed and the file is not modified.")
     
     def __call__(self, form, op_name, path):
-        do_giacc_convert(path, None, None)
+        do_giacc_query(path)
 
 
 
@@ -336,6 +624,18 @@ Operations  = [
     HelpOperation(),
 ]
 
+# Lookup tables for dispatching command lines to forms
+def group_forms_by_name(operations):
+    forms_by_name   = collections.defaultdict(list)
+    for op in operations:
+        for f in op.forms():
+            forms_by_name[f.name()].append(f)
+    
+    return forms_by_name
+
+Form_Index  = {(f.name(), len(f.parameters())): f for op in Operations for f in op.forms()}
+Forms_By_Name   = group_forms_by_name(Operations)
+
 
 
 if __name__ == "__main__":
@@ -347,21 +647,20 @@ if __name__ == "__main__":
     op_argv = sys.argv[2 : ]
     op_argc = len(op_argv)
     
-    # get list of forms with matching name
-    forms   = [f for op in Operations for f in op.forms() if f.name() == op_name]
+    # find the form with matching name and the right number of parameters
+    f   = Form_Index.get((op_name, op_argc))
     
-    if len(forms) == 0:
+    if f != None:
+        f(op_name, *op_argv)
+    
+    elif op_name not in Forms_By_Name:
         # no matching forms
         bad_argv(f"Unknown operation \"{sys.argv[1]}\"")
     
-    # find the form with the right number of parameters
-    for f in forms:
-        if len(f.parameters()) == op_argc:
-            f(op_name, *op_argv)
-            break
-        
     else:
         # wrong number of parameters passed - generate error message
+        forms   = Forms_By_Name[op_name]
+        
         if all(op_argc < len(f.parameters()) for f in forms):
             label   = "Too few"
         elif all(op_argc > len(f.parameters()) for f in forms):